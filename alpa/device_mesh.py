@@ -1115,7 +1115,10 @@ class DistributedPhysicalDeviceMesh(PhysicalDeviceMesh):
                     str(global_config.xla_client_mem_fraction),
                 "XLA_FLAGS": (os.environ.get("XLA_FLAGS", "") +
                               f" --xla_gpu_autotune_level"
-                              f"={global_config.xla_gpu_autotune_level}"),
+                              f"={global_config.xla_gpu_autotune_level}"
+                              " --xla_gpu_enable_async_all_reduce=" +
+                              ("false" if global_config.disable_async_all_reduce
+                               else "true")),
 
                 # "NCCL_LAUNCH_MODE": "PARALLEL",
                 # "XLA_FLAGS": "--xla_dump_to=hlo --xla_dump_hlo_pass_re=.*"
@@ -1,19 +1,60 @@
 """All global configurations for this project."""
 import os
 
+# Read the environment variables once at import time. GlobalConfig() only
+# copies these values.
+_XLA_CLIENT_MEM_FRACTION = float(
+    os.environ.get("XLA_PYTHON_CLIENT_MEM_FRACTION", 0.9))
+_XLA_GPU_AUTOTUNE_LEVEL = int(os.environ.get("ALPA_XLA_GPU_AUTOTUNE_LEVEL", 4))
+_USE_AWS_EFA = os.environ.get("ALPA_USE_AWS_EFA", "").lower() in ["true", "1"]
+_DISABLE_ASYNC_ALL_REDUCE = os.environ.get("ALPA_DISABLE_ASYNC_ALL_REDUCE",
+                                           "true").lower() in ["true", "1"]
+
 
 class GlobalConfig:
     """The global configuration of alpa."""
 
+    # Fix the set of options. Attribute access goes through slots instead of
+    # an instance dict, and a misspelled option raises an AttributeError
+    # instead of silently creating a new attribute.
+    __slots__ = ("xla_client_mem_fraction", "xla_gpu_autotune_level",
+                 "disable_async_all_reduce", "delete_remote_buffers_threshold",
+                 "use_aws_efa", "compile_random_seed", "runtime_random_seed",
+                 "shard_parallel_sync_for_timer",
+                 "debug_with_pipeshard_runtime",
+                 "profile_with_whole_ray_cluster", "profile_timeout",
+                 "profile_maximum_retry", "overwrite_submesh_choices",
+                 "always_donate_micro_batch_vars", "pipeline_check_alive",
+                 "pipeline_sync_for_timer", "pipeline_distributed_compile",
+                 "pipeline_use_signal_send_recv", "use_scatter_gather",
+                 "eagerly_create_communicators",
+                 "use_memzero_for_gradient_accumulation", "resharding_mode",
+                 "remat_using_while", "use_dummy_value_for_benchmarking",
+                 "print_compilation_time", "default_ray_namespace_prefix",
+                 "unittest_ray_namespace_prefix")
+
     def __init__(self):
         ########## Options of device mesh ##########
-        self.xla_client_mem_fraction = float(
-            os.environ.get("XLA_PYTHON_CLIENT_MEM_FRACTION", 0.9))
-        self.xla_gpu_autotune_level = 4
+        self.xla_client_mem_fraction = _XLA_CLIENT_MEM_FRACTION
+        # The XLA flags of the next two options are exported to XLA_FLAGS of
+        # the driver when alpa is imported, and passed to the mesh workers
+        # when they are launched. So set them with their environment
+        # variables before importing alpa. A value set in code only applies
+        # to the workers launched afterwards, not to the driver.
+        #
+        # The autotune level of the XLA GPU compiler
+        # (ALPA_XLA_GPU_AUTOTUNE_LEVEL). Level 4 also checks the correctness
+        # of the autotuned algorithms, which makes compilation much slower.
+        # Level 2 skips the check and is enough for benchmarking.
+        self.xla_gpu_autotune_level = _XLA_GPU_AUTOTUNE_LEVEL
+        # Whether to disable the async all-reduce of XLA
+        # (ALPA_DISABLE_ASYNC_ALL_REDUCE). Async all-reduce overlaps
+        # communication with the following computation. It is disabled by
+        # default to work around an earlier issue of XLA with it.
+        self.disable_async_all_reduce = _DISABLE_ASYNC_ALL_REDUCE
         self.delete_remote_buffers_threshold = 200
         # use AWS EFA network interface
-        self.use_aws_efa = os.environ.get("ALPA_USE_AWS_EFA",
-                                          "").lower() in ["true", "1"]
+        self.use_aws_efa = _USE_AWS_EFA
         # Random seed used for compilation
         self.compile_random_seed = 42
         # Random seed used for runtime
@@ -79,5 +120,10 @@ global_config = GlobalConfig()
 # Other environment setup
 is_worker = os.environ.get("ALPA_IS_WORKER", "False") == "True"
 
-os.environ["XLA_FLAGS"] = os.environ.get(
-    "XLA_FLAGS", "") + " --xla_gpu_enable_async_all_reduce=false"
+# Workers get these flags from the mesh launcher, so only set them for the
+# local backend of the driver.
+if not is_worker:
+    os.environ["XLA_FLAGS"] = os.environ.get("XLA_FLAGS", "") + (
+        f" --xla_gpu_autotune_level={global_config.xla_gpu_autotune_level}")
+    if global_config.disable_async_all_reduce:
+        os.environ["XLA_FLAGS"] += " --xla_gpu_enable_async_all_reduce=false"
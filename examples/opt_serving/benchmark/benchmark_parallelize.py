@@ -26,7 +26,7 @@ def test_opt_125M_shard_parallel():
     position_ids = build_position_ids(input_ids, config.pad)
     print("input_ids", input_ids)
 
-    model, params = init_model_aval(config, jnp.float16)
+    model, params = init_model_aval(config)
     params = load_params_np(params, np_weights_folder, config)
 
     # Get expected results
@@ -48,8 +48,11 @@ def test_opt_125M_shard_parallel():
                              attention_cache=batch["cache"])
         return output.logits, output.attention_cache
 
-    cache = build_init_cache(config)
+    cache = init_cache_np(config, 1)
 
+    # Check the results after the loop, so that fetching the logits does not
+    # block the dispatch of the next step.
+    logits_steps = []
     for i in range(input_ids.shape[1]):
         input_ids_step = input_ids[:, i:i + 1]
         position_ids_step = jnp.full_like(input_ids_step, i + config.pad + 1)
@@ -59,6 +62,8 @@ def test_opt_125M_shard_parallel():
                 "position_ids": position_ids_step,
                 "cache": cache,
             })
+        logits_steps.append(logits_step)
+    for i, logits_step in enumerate(logits_steps):
         assert_allclose(logits_step, logits_no_cache[:, i:i + 1])
 
     # Dump IR
@@ -118,6 +123,9 @@ def test_opt_125M_pipeshard_parallel():
 
     cache = init_cache_np(config, batch_size)
 
+    # Check the results after the loop, so that fetching the logits does not
+    # block the dispatch of the next step.
+    logits_steps = []
     for i in range(input_ids.shape[1]):
         input_ids_step = input_ids[:, i:i + 1]
         position_ids_step = jnp.full_like(input_ids_step, i + config.pad + 1)
@@ -127,6 +135,8 @@ def test_opt_125M_pipeshard_parallel():
                 "position_ids": position_ids_step,
                 "cache": cache,
             })
+        logits_steps.append(logits_step)
+    for i, logits_step in enumerate(logits_steps):
         assert_allclose(logits_step, logits_no_cache[:, i:i + 1])
 
     # Dump IR
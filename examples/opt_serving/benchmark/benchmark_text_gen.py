@@ -43,6 +43,7 @@ if __name__ == "__main__":
     parser.add_argument("--batch-size", type=int, default=1)
     parser.add_argument("--debug", action="store_true")
     parser.add_argument("--dtype", type=str, default="fp16")
+    parser.add_argument("--int8-kv-cache", action="store_true")
     args = parser.parse_args()
 
     # Some global params
@@ -64,6 +65,7 @@ if __name__ == "__main__":
     batch_size = args.batch_size
     autoregressive = not args.forward
     dtype = jnp.float16 if args.dtype == "fp16" else jnp.float32
+    kv_cache_dtype = jnp.int8 if args.int8_kv_cache else None
 
     if autoregressive:
         assert num_micro_batches == 1, "we only support num_micro_batches=1 for autoregressive!"
@@ -161,6 +163,7 @@ if __name__ == "__main__":
                           args.path,
                           autoregressive,
                           dtype=dtype,
+                          kv_cache_dtype=kv_cache_dtype,
                           dummy=args.dummy)
         load_time = time.time() - tic
 
@@ -0,0 +1,161 @@
+"""Check that the options that change the layout of the loaded weights or
+of the attention cache do not change the results, or change them only within
+the error of quantization.
+
+A tiny OPT model with random weights runs on CPU, so no real checkpoint or
+GPU is required.
+"""
+import dataclasses
+import os
+import tempfile
+
+os.environ.setdefault("JAX_PLATFORM_NAME", "cpu")
+
+import jax
+import jax.numpy as jnp
+import numpy as np
+from alpa.testing import assert_allclose
+
+from examples.opt_serving.model.opt_model import (OPTConfig, OPTSelfAttention,
+                                                  init_model_aval,
+                                                  init_cache_np,
+                                                  build_position_ids,
+                                                  load_params_np)
+
+
+def save_random_weights(config, path):
+    """Save random weights of config in the format of load_params_np."""
+    rng = np.random.RandomState(0)
+    dim = config.decoder_embed_dim
+    ffn_dim = config.decoder_ffn_embed_dim
+
+    def save(key, shape, offset=0.0):
+        # Save without the .npy suffix, as the converted OPT weights.
+        with open(os.path.join(path, key), "wb") as fout:
+            np.save(fout, (offset + 0.2 * rng.randn(*shape)).astype(np.float32))
+
+    save("decoder.embed_tokens.weight", (config.vocab_size, dim))
+    save("decoder.embed_positions.weight",
+         (config.max_target_positions + config.pad + 1, dim))
+    save("decoder.layer_norm.weight", (dim,), 1.0)
+    save("decoder.layer_norm.bias", (dim,))
+    for i in range(config.decoder_layers):
+        prefix = f"decoder.layers.{i}."
+        for name in ["q_proj", "k_proj", "v_proj", "out_proj"]:
+            save(prefix + f"self_attn.{name}.weight", (dim, dim))
+            save(prefix + f"self_attn.{name}.bias", (dim,))
+        # Use LayerNorm scales away from 1, so that folding them matters.
+        for name in ["self_attn_layer_norm", "final_layer_norm"]:
+            save(prefix + f"{name}.weight", (dim,), 1.0)
+            save(prefix + f"{name}.bias", (dim,))
+        save(prefix + "fc1.weight", (ffn_dim, dim))
+        save(prefix + "fc1.bias", (ffn_dim,))
+        save(prefix + "fc2.weight", (dim, ffn_dim))
+        save(prefix + "fc2.bias", (dim,))
+
+
+def run_model(config, path, input_ids, position_ids):
+    """Return the logits without the cache and with the cached decoding."""
+    model, params = init_model_aval(config)
+    params = load_params_np(params, path, config)
+
+    logits_no_cache = model.apply(params, input_ids, position_ids).logits
+
+    # Run the first two thirds of the prompt in two steps of several tokens,
+    # the second of which starts at a nonzero cache index. Then decode the
+    # rest one token at a time.
+    cache = init_cache_np(config, input_ids.shape[0])
+    num_prefill = input_ids.shape[1] // 3
+    logits_steps = []
+    for start in [0, num_prefill]:
+        output = model.apply(params,
+                             input_ids[:, start:start + num_prefill],
+                             position_ids[:, start:start + num_prefill],
+                             attention_cache=cache)
+        logits_steps.append(output.logits)
+        cache = output.attention_cache
+    for i in range(2 * num_prefill, input_ids.shape[1]):
+        output = model.apply(params,
+                             input_ids[:, i:i + 1],
+                             attention_cache=cache)
+        logits_steps.append(output.logits)
+        cache = output.attention_cache
+    return logits_no_cache, np.concatenate(logits_steps, axis=1)
+
+
+def test_weight_layouts():
+    config = OPTConfig(decoder_layers=4,
+                       max_target_positions=32,
+                       decoder_embed_dim=16,
+                       decoder_attention_heads=4,
+                       decoder_input_dim=16,
+                       decoder_ffn_embed_dim=64,
+                       vocab_size=64,
+                       dtype=jnp.float32,
+                       version=3,
+                       num_pp_stages=2,
+                       mark_boundary=False)
+    input_ids = np.array(
+        [[5, 16, 10, 27, 18, 8, 38, 23, 7], [9, 12, 40, 3, 61, 4, 33, 21, 17]],
+        dtype=np.int32)
+    position_ids = build_position_ids(input_ids, config.pad)
+
+    with tempfile.TemporaryDirectory() as path:
+        save_random_weights(config, path)
+        expected, _ = run_model(config, path, input_ids, position_ids)
+
+        # The int8 cache is quantized with one scale per token and head, so
+        # only the logits with the cache change. The tolerances of int8 are
+        # for logits of magnitude up to about 3.
+        cases = [
+            # (options, tolerance without the cache, tolerance with the cache)
+            (dict(fold_layer_norm=True), 1e-4, 1e-4),
+            (dict(scan_layers=True), 1e-4, 1e-4),
+            (dict(fold_layer_norm=True, scan_layers=True), 1e-4, 1e-4),
+            (dict(kv_cache_dtype=jnp.int8), 1e-4, 3e-2),
+            (dict(kv_cache_dtype=jnp.int8, scan_layers=True), 1e-4, 3e-2),
+            # The chunk sizes do not divide the lengths of the prompt (9) and
+            # of the steps with the cache (3), so the queries are padded.
+            (dict(attention_chunk_size=2), 1e-4, 1e-4),
+            (dict(attention_chunk_size=2, scan_layers=True), 1e-4, 1e-4),
+            (dict(attention_chunk_size=2, kv_cache_dtype=jnp.int8), 1e-4, 3e-2),
+            # The int8 kernels are quantized with one scale per output channel.
+            (dict(int8_weight=True), 5e-2, 5e-2),
+            (dict(int8_weight=True, scan_layers=True), 5e-2, 5e-2),
+        ]
+        for kwargs, tol_no_cache, tol_cache in cases:
+            print(f"Check {kwargs}")
+            logits_no_cache, logits_cache = run_model(
+                dataclasses.replace(config, **kwargs), path, input_ids,
+                position_ids)
+            assert_allclose(logits_no_cache,
+                            expected,
+                            rtol=tol_no_cache,
+                            atol=tol_no_cache)
+            assert_allclose(logits_cache,
+                            expected,
+                            rtol=tol_cache,
+                            atol=tol_cache)
+
+
+def test_chunked_attention_rejects_bias():
+    config = OPTConfig(decoder_embed_dim=16,
+                       decoder_attention_heads=4,
+                       dtype=jnp.float32,
+                       attention_chunk_size=2)
+    attention = OPTSelfAttention(config, dtype=config.dtype)
+    hidden_states = jnp.ones((1, 4, config.decoder_embed_dim))
+    params = attention.init(jax.random.PRNGKey(0), hidden_states)
+    # The chunked attention builds its own causal bias.
+    try:
+        attention.apply(params,
+                        hidden_states,
+                        attention_bias=jnp.zeros((1, 1, 4, 4)))
+    except AssertionError:
+        return
+    raise AssertionError("chunked attention accepted attention_bias")
+
+
+if __name__ == "__main__":
+    test_weight_layouts()
+    test_chunked_attention_rejects_bias()
@@ -1,32 +1,36 @@
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
+import os
 
+# Skip the correctness check of autotuning to compile faster.
+os.environ.setdefault("ALPA_XLA_GPU_AUTOTUNE_LEVEL", "2")
+
+from flax.traverse_util import flatten_dict
 import jax
 import jax.numpy as jnp
 import numpy as np
 
 from alpa.testing import assert_allclose
-from examples.opt_serving.model.opt_model import (get_config, init_model_aval,
-                                                  inference_step_no_cache,
-                                                  init_cache_np,
-                                                  build_position_ids,
-                                                  load_params_np)
+from examples.opt_serving.model.opt_model import (
+    get_opt_config, init_model_aval, inference_step_no_cache,
+    inference_step_prefill, init_cache_jnp, build_position_ids, load_params_np)
 
 
-def print_params(params, prefix=""):
-    for key, value in params.items():
-        if isinstance(value, dict):
-            print_params(value, prefix=prefix + key + ".")
-        else:
-            print(prefix + key, value.shape)
+def print_params(params):
+    for path, value in flatten_dict(params).items():
+        print(".".join(path), value.shape)
 
 
 def test_opt_125M():
     #TODO: align dtype
     name = "2.7B"
-    config = get_config(name)
+    config = get_opt_config(name)
     # np_weights_folder = f"/home/ubuntu/opt_weights/{name}_np"
     np_weights_folder = f"/dataset/opt_weights/{name}_np"
     batch_size = 1
+    # The first prompt_len tokens are processed by one prefill step, the
+    # rest are decoded one token at a time.
+    prompt_len = 4
 
     # Init model
     input_ids = np.array([[5625, 16, 10, 2721, 183, 8, 38, 236, 7]],
@@ -34,10 +38,54 @@ def test_opt_125M():
     input_ids = np.tile(input_ids, [batch_size, 1])
     position_ids = build_position_ids(input_ids, config.pad)
     print("input_ids", input_ids)
+    # Move the inputs to device once. All calls below reuse these buffers.
+    input_ids = jnp.asarray(input_ids)
+    position_ids = jnp.asarray(position_ids)
+    prompt_ids = input_ids[:, :prompt_len]
+    prompt_position_ids = position_ids[:, :prompt_len]
+    decode_ids = input_ids[:, prompt_len:]
+    decode_position_ids = position_ids[:, prompt_len:]
+
+    model, params_aval = init_model_aval(config)
+    cache_aval = jax.eval_shape(partial(init_cache_jnp, config, batch_size))
+
+    @jax.jit
+    def prefill(params, input_ids, position_ids, cache):
+        return inference_step_prefill(params, {
+            "input_ids": input_ids,
+            "position_ids": position_ids,
+            "cache": cache,
+        }, model.apply)
+
+    @jax.jit
+    def inference_with_cache(params, input_ids, position_ids, cache):
+        print("traced")
+
+        def inference_step(cache, i):
+            input_ids_step = jax.lax.dynamic_slice_in_dim(input_ids, i, 1, 1)
+            position_ids_step = jax.lax.dynamic_slice_in_dim(
+                position_ids, i, 1, 1)
+            output = model.apply(params,
+                                 input_ids_step,
+                                 position_ids_step,
+                                 attention_cache=cache)
+            return output.attention_cache, output.logits
 
-    model, params = init_model_aval(config)
-    params = load_params_np(params, np_weights_folder, config)
-    params = jax.tree_map(jnp.array, params)
+        # Decode one token per scan step
+        cache, logits = jax.lax.scan(inference_step, cache,
+                                     jnp.arange(input_ids.shape[1]))
+        # (seq, batch, 1, vocab) -> (batch, seq, vocab)
+        logits = logits[:, :, 0].transpose(1, 0, 2)
+        return logits, cache
+
+    # Compile on abstract arguments in the background while the weights
+    # are loaded. XLA releases the GIL during compilation.
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        compile_future = executor.submit(lambda: inference_with_cache.lower(
+            params_aval, decode_ids, decode_position_ids, cache_aval).compile())
+        params = load_params_np(params_aval, np_weights_folder, config)
+        params = jax.tree_map(jax.device_put, params)
+        inference_with_cache = compile_future.result()
 
     # Get expected results
     logits_no_cache = inference_step_no_cache(params, {
@@ -46,28 +94,13 @@ def test_opt_125M():
     }, model.apply)
     print("logits_no_cache", logits_no_cache)
 
-    # JIT
-    @partial(jax.jit)
-    def inference_step_with_cache(params, batch):
-        print("traced")
-        output = model.apply(params,
-                             batch["input_ids"],
-                             batch["position_ids"],
-                             attention_cache=batch["cache"])
-        return output.logits, output.attention_cache
-
-    cache = init_cache_np(config, input_ids.shape[0])
-
-    for i in range(input_ids.shape[1]):
-        input_ids_step = input_ids[:, i:i + 1]
-        position_ids_step = np.full_like(input_ids_step, i + config.pad + 1)
-        logits_step, cache = inference_step_with_cache(
-            params, {
-                "input_ids": input_ids_step,
-                "position_ids": position_ids_step,
-                "cache": cache
-            })
-        assert_allclose(logits_step, logits_no_cache[:, i:i + 1])
+    cache = init_cache_jnp(config, batch_size)
+    logits_prefill, cache = prefill(params, prompt_ids, prompt_position_ids,
+                                    cache)
+    assert_allclose(logits_prefill, logits_no_cache[:, :prompt_len])
+    logits_with_cache, cache = inference_with_cache(params, decode_ids,
+                                                    decode_position_ids, cache)
+    assert_allclose(logits_with_cache, logits_no_cache[:, prompt_len:])
 
 
 if __name__ == "__main__":
@@ -1,6 +1,8 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import dataclasses
 from dataclasses import dataclass
-from functools import partial
+from functools import lru_cache, partial
 import itertools
 import math
 import os
@@ -15,6 +17,7 @@ import flax.linen as nn
 import jax
 import flax
 from jax import lax
+from jax.experimental import host_callback
 import jax.numpy as jnp
 from jax.tree_util import tree_flatten, tree_unflatten, tree_leaves
 from jax.interpreters import pxla
@@ -61,6 +64,19 @@ class OPTConfig:
     pad: int = 1
     activation_fn: str = 'relu'
     dtype: any = jnp.float16
+    # The dtype of the attention cache. None means using dtype. Another float
+    # dtype stores the keys and values in that dtype. jnp.int8 stores a
+    # quantized cache, which halves the memory of the cache and fits
+    # larger batches or longer sequences. The int8 cache is converted to dtype
+    # before the matmuls, so it does not reduce the memory traffic of decoding.
+    kv_cache_dtype: any = None
+    # Store the kernels of the attention and FFN projections in int8 with one
+    # scale per output channel. This is a memory-only option: it halves the
+    # memory of the weights, but makes decoding slower. Each kernel is
+    # converted to a copy in dtype before its matmul, so decoding reads about
+    # 5 bytes per weight (int8 read, fp16 written and read again) instead
+    # of 2.
+    int8_weight: bool = False
     use_stable_embedding: bool = False
     no_scale_embedding: bool = True
     decoder_learned_pos: bool = True
@@ -73,6 +89,23 @@ class OPTConfig:
     num_pp_stages: int = None
     # parallelize
     mark_boundary: bool = True
+    # Recompute the activations of each layer in the backward pass
+    gradient_checkpointing: bool = False
+    # Run the layers of each pipeline stage with one nn.scan, which makes
+    # the HLO and the compilation time independent of the number of layers
+    scan_layers: bool = False
+    # Compute the attention of a prompt longer than this in chunks of this
+    # many queries, so that the full (seq_len, seq_len) scores are never
+    # materialized
+    attention_chunk_size: int = None
+    # Fold the scale and bias of the LayerNorms in each layer into the dense
+    # layers that follow them when loading the weights
+    fold_layer_norm: bool = False
+    # If set, output_attentions copies the attention weights of each layer
+    # to the host by calling attention_weights_tap(weights, transforms) with
+    # host_callback.id_tap, in the order of the layers, instead of returning
+    # all the (batch, heads, seq_len, seq_len) weights in the output
+    attention_weights_tap: Callable = None
 
 
 class OPTEmbeddings(nn.Module):
@@ -115,6 +148,106 @@ class OPTEmbeddings(nn.Module):
         return hidden_states
 
 
+class Int8Dense(nn.Module):
+    """A dense layer with an int8 kernel and one scale per output channel."""
+
+    features: int
+    dtype: jnp.dtype = jnp.float16  # the dtype of the computation
+
+    @nn.compact
+    def __call__(self, inputs):
+        kernel = self.param("kernel", nn.initializers.zeros,
+                            (inputs.shape[-1], self.features), jnp.int8)
+        scale = self.param("scale", nn.initializers.ones, (self.features,))
+        bias = self.param("bias", nn.initializers.zeros, (self.features,))
+        inputs = jnp.asarray(inputs, self.dtype)
+        # Rescale the output instead of the kernel. The int8 kernel is still
+        # converted to a copy in dtype for the matmul, so this saves memory
+        # but makes the layer slower than nn.Dense.
+        y = lax.dot_general(inputs,
+                            kernel.astype(self.dtype),
+                            (((inputs.ndim - 1,), (0,)), ((), ())),
+                            preferred_element_type=self.dtype)
+        return y * jnp.asarray(scale, self.dtype) + jnp.asarray(
+            bias, self.dtype)
+
+
+def get_dense_cls(config):
+    return Int8Dense if config.int8_weight else nn.Dense
+
+
+def get_causal_attention_bias(query_offset, num_queries, num_keys, dtype):
+    """Get the (1, 1, num_queries, num_keys) bias of causal attention.
+
+    The i-th query is at position query_offset + i and attends to the keys at
+    positions up to its own. The mask is built from iotas, which XLA fuses
+    into the consumer, so no (num_queries, num_keys) constant is materialized.
+    """
+    shape = (num_queries, num_keys)
+    query_positions = query_offset + lax.broadcasted_iota(jnp.int32, shape, 0)
+    key_positions = lax.broadcasted_iota(jnp.int32, shape, 1)
+    # Use a select instead of multiplying the mask by -1e10, which is -inf in
+    # float16 and turns the unmasked entries into nan. Clip -1e10 to the
+    # range of dtype as well.
+    big_neg = max(-1e10, float(jnp.finfo(dtype).min))
+    bias = jnp.where(key_positions > query_positions,
+                     jnp.array(big_neg, dtype), jnp.array(0, dtype))
+    return bias[None, None, :, :]
+
+
+def get_layer_attention_bias(num_queries, layer_attention_cache, dtype):
+    """Get the causal bias of the layers that use layer_attention_cache.
+
+    The cache may be stacked over the layers of a stage when
+    config.scan_layers is set. All layers that share a cache index share the
+    bias.
+    """
+    if layer_attention_cache is None:
+        return get_causal_attention_bias(0, num_queries, num_queries, dtype)
+    # The cache index of the first sequence, as in OPTSelfAttention
+    query_offset = layer_attention_cache[-1].reshape(-1)[0]
+    return get_causal_attention_bias(query_offset, num_queries,
+                                     layer_attention_cache[0].shape[-3], dtype)
+
+
+def use_chunked_attention(config, num_queries, output_attentions):
+    """Whether the attention of num_queries queries is computed in chunks."""
+    return (not output_attentions and
+            config.attention_chunk_size is not None and
+            num_queries > config.attention_chunk_size)
+
+
+def chunked_causal_attention(query, key, value, query_offset, chunk_size,
+                             dtype):
+    """Compute causal attention for chunks of chunk_size queries at a time.
+
+    The i-th query is at position query_offset + i. Only the scores of one
+    chunk, (batch, heads, chunk_size, keys), are live at a time, instead of
+    the scores of all queries. The queries are padded to a multiple of
+    chunk_size.
+    """
+    batch_size, seq_len, num_heads, head_dim = query.shape
+    num_chunks = -(-seq_len // chunk_size)
+    query = jnp.pad(query, ((0, 0), (0, num_chunks * chunk_size - seq_len),
+                            (0, 0), (0, 0)))
+    query = query.reshape(
+        (batch_size, num_chunks, chunk_size, num_heads, head_dim))
+
+    def attend(args):
+        chunk_id, query_chunk = args
+        bias = get_causal_attention_bias(query_offset + chunk_id * chunk_size,
+                                         chunk_size, key.shape[1], dtype)
+        return nn.attention.dot_product_attention(query_chunk,
+                                                  key,
+                                                  value,
+                                                  bias=bias,
+                                                  dtype=dtype)
+
+    output = lax.map(attend, (jnp.arange(num_chunks), query.swapaxes(0, 1)))
+    return output.swapaxes(0, 1).reshape(
+        (batch_size, num_chunks * chunk_size, num_heads, head_dim))[:, :seq_len]
+
+
 class OPTSelfAttention(nn.Module):
     config: OPTConfig
     dtype: jnp.dtype = jnp.float16  # the dtype of the computation
@@ -126,7 +259,7 @@ class OPTSelfAttention(nn.Module):
                 f"multiple of `decoder_attention_heads`: {self.config.decoder_attention_heads}"
             )
 
-        self.qvk_combined = nn.Dense(
+        self.qvk_combined = get_dense_cls(self.config)(
             self.config.decoder_embed_dim * 3,
             dtype=self.dtype,
         )
@@ -134,55 +267,115 @@ class OPTSelfAttention(nn.Module):
     def __call__(self,
                  hidden_states,
                  output_attentions: bool = False,
-                 attention_cache=None):
+                 attention_cache=None,
+                 attention_bias=None):
         head_dim = self.config.decoder_embed_dim // self.config.decoder_attention_heads
 
-        qvk_combined_states = self.qvk_combined(hidden_states)
-        qvk_combined_states = qvk_combined_states.reshape(
-            qvk_combined_states.shape[:2] + (-1, 3))
-        query_states, value_states, key_states = jnp.split(qvk_combined_states,
-                                                           3,
-                                                           axis=3)
-
-        query_states = query_states.reshape(hidden_states.shape[:2] + (
-            self.config.decoder_attention_heads, head_dim))
-        value_states = value_states.reshape(hidden_states.shape[:2] + (
-            self.config.decoder_attention_heads, head_dim))
-        key_states = key_states.reshape(hidden_states.shape[:2] +
-                                        (self.config.decoder_attention_heads,
-                                         head_dim))
-
+        # The kernel of qvk_combined is laid out as (heads, 3, head_dim), so
+        # that each shard of a column-partitioned kernel holds whole heads,
+        # and query, value and key are contiguous runs of head_dim.
+        qvk_combined_states = self.qvk_combined(hidden_states).reshape(
+            hidden_states.shape[:2] +
+            (self.config.decoder_attention_heads, 3, head_dim))
+        query_states = qvk_combined_states[..., 0, :]
+        value_states = qvk_combined_states[..., 1, :]
+        key_states = qvk_combined_states[..., 2, :]
+
+        # The scales of an int8 attention cache
+        key_scale = value_scale = None
+        chunked = use_chunked_attention(self.config, query_states.shape[1],
+                                        output_attentions)
+        # The chunked attention builds the causal bias of each chunk itself.
+        assert not (chunked and attention_bias is not None), (
+            "chunked attention does not support attention_bias")
+        # The bias is in self.dtype, so that the attention scores and the
+        # softmax stay in the dtype of the computation instead of being
+        # promoted to float32.
         if attention_cache is None:
-            attention_bias = jnp.expand_dims(
-                jnp.triu(
-                    jnp.full((query_states.shape[1], key_states.shape[1]),
-                             -1e10), 1), (0, 1))
+            query_offset = 0
+            if attention_bias is None and not chunked:
+                attention_bias = get_causal_attention_bias(
+                    0, query_states.shape[1], key_states.shape[1], self.dtype)
         else:
-            # attention_bias = jnp.expand_dims(jnp.triu(jnp.full(
-            #     (query_states.shape[1], key_states.shape[1]), -1e10), 1), (0, 1))
-            cache_key, cache_value, cache_index = attention_cache
+            cache_index = attention_cache[-1]
             cache_index_ = cache_index[0]
-            key_states = lax.dynamic_update_slice(cache_key, key_states,
-                                                  (0, cache_index_, 0, 0))
-            value_states = lax.dynamic_update_slice(cache_value, value_states,
-                                                    (0, cache_index_, 0, 0))
+            query_offset = cache_index_
+            if get_kv_cache_dtype(self.config) == jnp.int8:
+                (cache_key, cache_value, cache_key_scale,
+                 cache_value_scale) = attention_cache[:-1]
+                key_states, key_scale = quantize_kv(key_states)
+                value_states, value_scale = quantize_kv(value_states)
+                cache_key = lax.dynamic_update_slice(cache_key, key_states,
+                                                     (0, cache_index_, 0, 0))
+                cache_value = lax.dynamic_update_slice(cache_value,
+                                                       value_states,
+                                                       (0, cache_index_, 0, 0))
+                cache_key_scale = lax.dynamic_update_slice(
+                    cache_key_scale, key_scale.astype(cache_key_scale.dtype),
+                    (0, cache_index_, 0))
+                cache_value_scale = lax.dynamic_update_slice(
+                    cache_value_scale,
+                    value_scale.astype(cache_value_scale.dtype),
+                    (0, cache_index_, 0))
+                new_cache = (cache_key, cache_value, cache_key_scale,
+                             cache_value_scale)
+                key_states, value_states = cache_key, cache_value
+                key_scale, value_scale = cache_key_scale, cache_value_scale
+            else:
+                cache_key, cache_value = attention_cache[:-1]
+                cache_key = lax.dynamic_update_slice(
+                    cache_key, key_states.astype(cache_key.dtype),
+                    (0, cache_index_, 0, 0))
+                cache_value = lax.dynamic_update_slice(
+                    cache_value, value_states.astype(cache_value.dtype),
+                    (0, cache_index_, 0, 0))
+                new_cache = (cache_key, cache_value)
+                key_states = cache_key.astype(self.dtype)
+                value_states = cache_value.astype(self.dtype)
             num_updated_cache_vectors = query_states.shape[1]
-            max_length = key_states.shape[1]
-            attention_bias = (jnp.arange(max_length) >=
-                              cache_index_ + num_updated_cache_vectors).astype(
-                                  self.dtype) * -1e10
-            attention_bias = attention_bias[None, None, None, :]
-            attention_cache = key_states, value_states, cache_index + num_updated_cache_vectors
-        attn_weights = nn.attention.dot_product_attention_weights(
-            query_states,
-            key_states,
-            bias=attention_bias,
-            dtype=self.dtype,
-            precision=None,
-        )
-
-        attn_output = jnp.einsum("...hqk,...khd->...qhd", attn_weights,
-                                 value_states)
+            # Each new token attends to the cached tokens and to the new
+            # tokens up to itself.
+            if attention_bias is None and not chunked:
+                attention_bias = get_causal_attention_bias(
+                    cache_index_, num_updated_cache_vectors,
+                    key_states.shape[1], self.dtype)
+            attention_cache = new_cache + (cache_index +
+                                           num_updated_cache_vectors,)
+        if chunked:
+            if key_scale is not None:
+                key_states = dequantize_kv(key_states, key_scale, self.dtype)
+                value_states = dequantize_kv(value_states, value_scale,
+                                             self.dtype)
+            attn_output = chunked_causal_attention(
+                query_states, key_states, value_states, query_offset,
+                self.config.attention_chunk_size, self.dtype)
+        else:
+            if key_scale is None:
+                attn_weights = nn.attention.dot_product_attention_weights(
+                    query_states,
+                    key_states,
+                    bias=attention_bias,
+                    dtype=self.dtype,
+                    precision=None,
+                )
+            else:
+                attn_weights = int8_key_attention_weights(
+                    query_states, key_states, key_scale, attention_bias,
+                    self.dtype)
+            if output_attentions and self.config.attention_weights_tap:
+                attn_weights = host_callback.id_tap(
+                    self.config.attention_weights_tap, attn_weights)
+
+            if value_scale is None:
+                attn_output = jnp.einsum("...hqk,...khd->...qhd", attn_weights,
+                                         value_states)
+            else:
+                # Scale the weights of each key instead of the values.
+                attn_output = jnp.einsum(
+                    "...hqk,...khd->...qhd",
+                    attn_weights * jnp.swapaxes(
+                        value_scale, -1, -2)[..., None, :].astype(self.dtype),
+                    value_states.astype(self.dtype))
         attn_output = attn_output.reshape(attn_output.shape[:2] + (-1,))
 
         outputs = (attn_output, attention_cache,
@@ -198,22 +391,27 @@ class OPTAttention(nn.Module):
     def setup(self):
         assert self.config.decoder_normalize_before
         self.self = OPTSelfAttention(self.config, dtype=self.dtype)
-        self.dense = nn.Dense(
+        self.dense = get_dense_cls(self.config)(
             self.config.decoder_embed_dim,
             dtype=self.dtype,
         )
-        self.layer_norm = nn.LayerNorm(epsilon=self.config.layer_norm_eps,
-                                       dtype=self.dtype)
+        self.layer_norm = nn.LayerNorm(
+            epsilon=self.config.layer_norm_eps,
+            dtype=self.dtype,
+            use_bias=not self.config.fold_layer_norm,
+            use_scale=not self.config.fold_layer_norm)
 
     def __call__(self,
                  hidden_states,
                  output_attentions: bool = False,
-                 attention_cache=None):
+                 attention_cache=None,
+                 attention_bias=None):
         residual = hidden_states
         hidden_states = self.layer_norm(hidden_states)
         attn_outputs = self.self(hidden_states,
                                  output_attentions=output_attentions,
-                                 attention_cache=attention_cache)
+                                 attention_cache=attention_cache,
+                                 attention_bias=attention_bias)
         attn_output = attn_outputs[0]
         attention_cache = attn_outputs[1]
         hidden_states = self.dense(attn_output)
@@ -231,17 +429,20 @@ class OPTFFN(nn.Module):
     dtype: jnp.dtype = jnp.float16  # the dtype of the computation
 
     def setup(self):
-        self.fc1 = nn.Dense(
+        self.fc1 = get_dense_cls(self.config)(
             self.config.decoder_ffn_embed_dim,
             dtype=self.dtype,
         )
         self.activation = ACT2FN[self.config.activation_fn]
-        self.fc2 = nn.Dense(
+        self.fc2 = get_dense_cls(self.config)(
             self.config.decoder_embed_dim,
             dtype=self.dtype,
         )
-        self.layer_norm = nn.LayerNorm(epsilon=self.config.layer_norm_eps,
-                                       dtype=self.dtype)
+        self.layer_norm = nn.LayerNorm(
+            epsilon=self.config.layer_norm_eps,
+            dtype=self.dtype,
+            use_bias=not self.config.fold_layer_norm,
+            use_scale=not self.config.fold_layer_norm)
 
     def __call__(self, hidden_states):
         residual = hidden_states
@@ -268,11 +469,13 @@ class OPTTransformerLayer(nn.Module):
     def __call__(self,
                  hidden_states,
                  output_attentions: bool = False,
-                 attention_cache=None):
+                 attention_cache=None,
+                 attention_bias=None):
 
         attention_outputs = self.attention(hidden_states,
                                            output_attentions=output_attentions,
-                                           attention_cache=attention_cache)
+                                           attention_cache=attention_cache,
+                                           attention_bias=attention_bias)
         attention_output = attention_outputs[0]
         attention_cache = attention_outputs[1]
 
@@ -285,15 +488,50 @@ class OPTTransformerLayer(nn.Module):
         return outputs
 
 
+class OPTScanLayer(OPTTransformerLayer):
+    """An OPTTransformerLayer with the signature that nn.scan expects.
+
+    The hidden states are the carry, the attention cache of the layer is
+    scanned over and the attention bias is broadcast to all layers.
+    """
+
+    def __call__(self, hidden_states, attention_cache, attention_bias):
+        outputs = super().__call__(hidden_states,
+                                   attention_cache=attention_cache,
+                                   attention_bias=attention_bias)
+        return outputs[0], outputs[1]
+
+
 class OPTTransformerLayerCollection(nn.Module):
     config: OPTConfig
     dtype: jnp.dtype = jnp.float16  # the dtype of the computation
 
     def setup(self):
-        self.layers = [
-            OPTTransformerLayer(self.config, name=str(i), dtype=self.dtype)
-            for i in range(self.config.decoder_layers)
-        ]
+        if self.config.gradient_checkpointing:
+            trans_func = partial(nn.remat, concrete=True)
+        else:
+            trans_func = lambda x: x
+
+        if self.config.scan_layers:
+            # Use one scan over the layers of each pipeline stage, whose
+            # params are stacked along a new leading axis.
+            num_stages = self.config.num_pp_stages or 1
+            layer_cls = nn.scan(trans_func(OPTScanLayer),
+                                variable_axes={"params": 0},
+                                split_rngs={"params": True},
+                                in_axes=(0, nn.broadcast),
+                                length=self.config.decoder_layers // num_stages)
+            self.layers = [
+                layer_cls(self.config, name=str(i), dtype=self.dtype)
+                for i in range(num_stages)
+            ]
+        else:
+            self.layers = [
+                trans_func(OPTTransformerLayer)(self.config,
+                                                name=str(i),
+                                                dtype=self.dtype)
+                for i in range(self.config.decoder_layers)
+            ]
 
     def __call__(
         self,
@@ -303,34 +541,69 @@ class OPTTransformerLayerCollection(nn.Module):
         return_dict: bool = True,
         attention_cache=None,
     ):
-        all_attentions = () if output_attentions else None
+        # The tapped attention weights are copied to the host, not returned
+        return_attentions = (output_attentions and
+                             not self.config.attention_weights_tap)
+        all_attentions = () if return_attentions else None
         all_hidden_states = () if output_hidden_states else None
         new_attention_cache = () if attention_cache is not None else None
+        # The chunked attention builds its own causal bias.
+        chunked = use_chunked_attention(self.config, hidden_states.shape[1],
+                                        output_attentions)
+        attention_bias = None
 
         if self.config.num_pp_stages is not None:
             assert self.config.decoder_layers % self.config.num_pp_stages == 0
             layers_per_stage = self.config.decoder_layers // self.config.num_pp_stages
 
-        for i, layer in enumerate(self.layers):
-            if self.config.num_pp_stages is not None:
-                if i % layers_per_stage == 0 and i != 0:
-                    stage_id = i // layers_per_stage
-                    if self.config.mark_boundary:
-                        mark_pipeline_boundary()
-
-            if output_hidden_states:
-                all_hidden_states += (hidden_states,)
-            layer_attention_cache = None
-            if attention_cache is not None:
-                layer_attention_cache = attention_cache[i]
-            layer_outputs = layer(hidden_states,
-                                  output_attentions=output_attentions,
-                                  attention_cache=layer_attention_cache)
-            hidden_states = layer_outputs[0]
-            if attention_cache is not None:
-                new_attention_cache += (layer_outputs[1],)
-            if output_attentions:
-                all_attentions += (layer_outputs[2],)
+        if self.config.scan_layers:
+            assert not output_attentions and not output_hidden_states, (
+                "scan_layers does not support per-layer outputs")
+            for stage_id, stage_layers in enumerate(self.layers):
+                if stage_id != 0 and self.config.mark_boundary:
+                    mark_pipeline_boundary()
+                stage_attention_cache = None
+                if attention_cache is not None:
+                    stage_attention_cache = attention_cache[stage_id]
+                attention_bias = None
+                if not chunked:
+                    attention_bias = get_layer_attention_bias(
+                        hidden_states.shape[1], stage_attention_cache,
+                        self.dtype)
+                hidden_states, stage_attention_cache = stage_layers(
+                    hidden_states, stage_attention_cache, attention_bias)
+                if attention_cache is not None:
+                    new_attention_cache += (stage_attention_cache,)
+        else:
+            for i, layer in enumerate(self.layers):
+                if self.config.num_pp_stages is not None:
+                    if i % layers_per_stage == 0 and i != 0:
+                        stage_id = i // layers_per_stage
+                        if self.config.mark_boundary:
+                            mark_pipeline_boundary()
+
+                if output_hidden_states:
+                    all_hidden_states += (hidden_states,)
+                layer_attention_cache = None
+                if attention_cache is not None:
+                    layer_attention_cache = attention_cache[i]
+                # Build the bias once per pipeline stage, from the cache of
+                # the stage, so that it is not sent between the stages.
+                if not chunked and (i == 0 or
+                                    (self.config.num_pp_stages is not None and
+                                     i % layers_per_stage == 0)):
+                    attention_bias = get_layer_attention_bias(
+                        hidden_states.shape[1], layer_attention_cache,
+                        self.dtype)
+                layer_outputs = layer(hidden_states,
+                                      output_attentions=output_attentions,
+                                      attention_cache=layer_attention_cache,
+                                      attention_bias=attention_bias)
+                hidden_states = layer_outputs[0]
+                if attention_cache is not None:
+                    new_attention_cache += (layer_outputs[1],)
+                if return_attentions:
+                    all_attentions += (layer_outputs[2],)
 
         if output_hidden_states:
             all_hidden_states += (hidden_states,)
@@ -362,12 +635,23 @@ class OPTTransformerModule(nn.Module):
     def __call__(
         self,
         input_ids,
-        position_ids,
+        position_ids=None,
         output_attentions: bool = False,
         output_hidden_states: bool = False,
         return_dict: bool = True,
         attention_cache=None,
     ):
+        if position_ids is None:
+            # Derive the positions of the new tokens from the cache index,
+            # which is already on device, instead of uploading them from the
+            # host on every decoding step.
+            assert attention_cache is not None, (
+                "position_ids is required without attention_cache")
+            cache_index = attention_cache[0][-1]
+            if self.config.scan_layers:
+                cache_index = cache_index[0]
+            position_ids = (cache_index[:, None] + self.config.pad + 1 +
+                            jnp.arange(input_ids.shape[1], dtype=jnp.int32))
         hidden_states = self.embeddings(input_ids, position_ids)
         outputs = self.encoder(
             hidden_states,
@@ -416,7 +700,7 @@ class OPTForLMModule(nn.Module):
     def __call__(
         self,
         input_ids,
-        position_ids,
+        position_ids=None,
         output_attentions: bool = False,
         output_hidden_states: bool = False,
         return_dict: bool = True,
@@ -438,13 +722,17 @@ class OPTForLMModule(nn.Module):
             hidden_states = self.project_out_dim(hidden_states)
 
         if self.config.share_decoder_input_output_embed:
-            if self.dtype == jnp.float16:
-                shared_embedding = self.transformers.embeddings.word_embeddings.embedding_fp16
-            else:
-                shared_embedding = self.transformers.variables["params"][
-                    "embeddings"]["word_embeddings"]["embedding"]
+            # Cast the embedding on the fly. This is a no-op when the params
+            # are already in self.dtype, so no second copy of the table is made.
+            shared_embedding = jnp.asarray(
+                self.transformers.variables["params"]["embeddings"]
+                ["word_embeddings"]["embedding"], self.dtype)
             assert self.decoder is None
-            logits = hidden_states @ shared_embedding.T
+            # Contract with the last axis of the embedding directly instead
+            # of transposing the (vocab_size, dim) matrix.
+            logits = lax.dot_general(
+                hidden_states, shared_embedding,
+                (((hidden_states.ndim - 1,), (1,)), ((), ())))
         else:
             assert self.decoder is not None
             logits = self.decoder(hidden_states)
@@ -518,52 +806,119 @@ def get_opt_config(name, **kwargs):
     return dataclasses.replace(config, **kwargs)
 
 
+@lru_cache()
 def init_model_aval(config):
+    """Create the model and its abstract params.
+
+    The result is cached per config, so repeated calls skip rebuilding the
+    module and tracing model.init.
+    """
     model = OPTForLMModule(config, dtype=config.dtype)
     rngkey = jax.core.ShapedArray((2,), jnp.uint32)
     input_ids = jax.core.ShapedArray((1, 128), jnp.int32)
     position_ids = jax.core.ShapedArray((1, 128), jnp.int32)
     params = jax.eval_shape(model.init, rngkey, input_ids, position_ids)
-    params = jax.tree_map(lambda x: jax.ShapeDtypeStruct(x.shape, config.dtype),
-                          params)
+    # Cast the float params to config.dtype and keep the int8 kernels.
+    params = jax.tree_map(
+        lambda x: jax.ShapeDtypeStruct(
+            x.shape, x.dtype if x.dtype == jnp.int8 else config.dtype), params)
     return model, params
 
 
-def init_cache_aval(config, batch_size):
+def get_kv_cache_dtype(config):
+    """Get the dtype of the attention cache as a numpy dtype."""
+    if config.kv_cache_dtype is None:
+        return jnp.dtype(config.dtype)
+    dtype = jnp.dtype(config.kv_cache_dtype)
+    assert dtype == jnp.int8 or jnp.issubdtype(dtype, jnp.floating), (
+        f"Unsupported kv_cache_dtype: {dtype}")
+    return dtype
+
+
+def get_layer_cache_specs(config, batch_size):
+    """Get the (shape, dtype) of all arrays in the attention cache of a layer.
+
+    The cache of a layer is (key, value, index). If config.kv_cache_dtype is
+    int8, it is (key, value, key_scale, value_scale, index), where key and
+    value are quantized with one scale per token and head.
+    """
     head_dim = config.decoder_embed_dim // config.decoder_attention_heads
+    kv_shape = (batch_size, config.max_target_positions,
+                config.decoder_attention_heads, head_dim)
+    index_spec = ((batch_size,), jnp.int32)
+
+    kv_dtype = get_kv_cache_dtype(config)
+    if kv_dtype == jnp.int8:
+        scale_shape = kv_shape[:-1]
+        return ((kv_shape, jnp.int8), (kv_shape, jnp.int8),
+                (scale_shape, config.dtype), (scale_shape, config.dtype),
+                index_spec)
+    return ((kv_shape, kv_dtype), (kv_shape, kv_dtype), index_spec)
+
+
+def get_cache_specs(config, batch_size):
+    """Get the (shape, dtype) of all arrays in the attention cache.
+
+    The cache has one layer cache per layer. If config.scan_layers is set, it
+    has one per pipeline stage instead, whose arrays are stacked over the
+    layers of the stage along a new leading axis.
+    """
+    specs = get_layer_cache_specs(config, batch_size)
+    if config.scan_layers:
+        num_stages = config.num_pp_stages or 1
+        layers_per_stage = config.decoder_layers // num_stages
+        specs = tuple(
+            ((layers_per_stage,) + shape, dtype) for shape, dtype in specs)
+        return (specs,) * num_stages
+    return (specs,) * config.decoder_layers
 
-    all_cache = []
-    for i in range(config.decoder_layers):
-        layer_cache = (
-            jax.core.ShapedArray((batch_size, config.max_target_positions,
-                                  config.decoder_attention_heads, head_dim),
-                                 config.dtype),
-            jax.core.ShapedArray((batch_size, config.max_target_positions,
-                                  config.decoder_attention_heads, head_dim),
-                                 config.dtype),
-            jax.core.ShapedArray((batch_size,), jnp.int32),
-        )
-        all_cache.append(layer_cache)
-    return tuple(all_cache)
+
+def init_cache_aval(config, batch_size):
+    return tuple(
+        tuple(jax.core.ShapedArray(shape, dtype)
+              for shape, dtype in specs)
+        for specs in get_cache_specs(config, batch_size))
 
 
 def init_cache_np(config, batch_size):
-    np_dtype = np.float32 if config.dtype == jnp.float32 else np.float16
-    head_dim = config.decoder_embed_dim // config.decoder_attention_heads
+    return tuple(
+        tuple(np.zeros(shape, dtype)
+              for shape, dtype in specs)
+        for specs in get_cache_specs(config, batch_size))
 
-    all_cache = []
-    for i in range(config.decoder_layers):
-        layer_cache = (
-            np.zeros((batch_size, config.max_target_positions,
-                      config.decoder_attention_heads, head_dim),
-                     dtype=np_dtype),
-            np.zeros((batch_size, config.max_target_positions,
-                      config.decoder_attention_heads, head_dim),
-                     dtype=np_dtype),
-            np.zeros((batch_size,), np.int32),
-        )
-        all_cache.append(layer_cache)
-    return tuple(all_cache)
+
+def init_cache_jnp(config, batch_size):
+    """Allocate a zero-initialized cache directly on the default device."""
+    return tuple(
+        tuple(jnp.zeros(shape, dtype)
+              for shape, dtype in specs)
+        for specs in get_cache_specs(config, batch_size))
+
+
+def quantize_kv(x):
+    """Quantize key/value states to int8 with one scale per token and head."""
+    x = x.astype(jnp.float32)
+    scale = jnp.max(jnp.abs(x), axis=-1) / 127
+    x = jnp.round(x / jnp.maximum(scale, 1e-8)[..., None])
+    return x.astype(jnp.int8), scale
+
+
+def dequantize_kv(x, scale, dtype):
+    return x.astype(dtype) * scale[..., None].astype(dtype)
+
+
+def int8_key_attention_weights(query, key, key_scale, bias, dtype):
+    """Compute dot_product_attention_weights with a key quantized by
+    quantize_kv.
+
+    The scores are multiplied by the scale of each key, instead of
+    multiplying the whole (batch, keys, heads, head_dim) key by its scales.
+    """
+    query = query / jnp.sqrt(query.shape[-1]).astype(dtype)
+    scores = jnp.einsum("...qhd,...khd->...hqk", query, key.astype(dtype))
+    key_scale = jnp.swapaxes(key_scale, -1, -2)[..., None, :]
+    scores = scores * key_scale.astype(dtype)
+    return jax.nn.softmax(scores + bias).astype(dtype)
 
 
 def build_position_ids(input_ids, padding_idx):
@@ -577,13 +932,168 @@ def inference_step_no_cache(params, batch, apply_func):
     return logits
 
 
+def inference_step_prefill(params, batch, apply_func):
+    """Run all prompt tokens in one step and write their keys and values into
+    the cache, instead of decoding the prompt one token at a time."""
+    output = apply_func(params,
+                        batch["input_ids"],
+                        batch["position_ids"],
+                        attention_cache=batch["cache"])
+    return output.logits, output.attention_cache
+
+
+def quantize_weight_np(kernel):
+    """Quantize a (in, out) kernel to int8 with one scale per output channel.
+
+    Return the int8 kernel and the scales in the dtype of the kernel.
+    """
+    dtype = kernel.dtype
+    kernel = kernel.astype(np.float32)
+    scale = np.maximum(np.abs(kernel).max(axis=0) / 127, 1e-8)
+    return np.round(kernel / scale).astype(np.int8), scale.astype(dtype)
+
+
+def fold_layer_norm_np(scale, bias, kernel, kernel_bias):
+    """Fold the scale and bias of a LayerNorm into the following dense layer.
+
+    (x * scale + bias) @ kernel + kernel_bias is equal to
+    x @ (scale[:, None] * kernel) + (bias @ kernel + kernel_bias).
+    """
+    dtype = kernel.dtype
+    kernel = kernel.astype(np.float32)
+    new_kernel = scale.astype(np.float32)[:, None] * kernel
+    new_bias = bias.astype(np.float32) @ kernel + kernel_bias.astype(
+        np.float32)
+    return new_kernel.astype(dtype), new_bias.astype(dtype)
+
+
+def get_layer_params_np(load_array, layer_id, config):
+    """Load the params of a transformer layer.
+
+    Return a list of (key, array), where key is relative to the layer, e.g.
+    "ffn.fc1.bias".
+    """
+    load_prefix = f"decoder.layers.{layer_id}."
+    layer_params = []
+
+    def load_param(param_key, loaded_array):
+        layer_params.append((param_key, loaded_array))
+
+    def load_kernel(param_key, kernel):
+        if config.int8_weight:
+            kernel, scale = quantize_weight_np(kernel)
+            load_param(param_key + ".scale", scale)
+        load_param(param_key + ".kernel", kernel)
+
+    # Attention weights
+    wq = load_array(load_prefix + "self_attn.q_proj.weight")
+    wk = load_array(load_prefix + "self_attn.k_proj.weight")
+    wv = load_array(load_prefix + "self_attn.v_proj.weight")
+    # Pack q, v and k along the output axis in the (heads, 3, head_dim)
+    # layout of qvk_combined. Write each of them into place directly, so the
+    # packed kernel is written in one pass.
+    dim = wq.shape[-1]
+    num_heads = config.decoder_attention_heads
+    head_dim = wq.shape[0] // num_heads
+    w_qvk = np.empty((dim, num_heads, 3, head_dim), dtype=wq.dtype)
+    w_qvk[:, :, 0] = wq.T.reshape(dim, num_heads, head_dim)
+    w_qvk[:, :, 1] = wv.T.reshape(dim, num_heads, head_dim)
+    w_qvk[:, :, 2] = wk.T.reshape(dim, num_heads, head_dim)
+    w_qvk = w_qvk.reshape(dim, 3 * wq.shape[0])
+    bq = load_array(load_prefix + "self_attn.q_proj.bias")
+    bk = load_array(load_prefix + "self_attn.k_proj.bias")
+    bv = load_array(load_prefix + "self_attn.v_proj.bias")
+    b_qvk = np.empty((num_heads, 3, head_dim), dtype=bq.dtype)
+    b_qvk[:, 0] = bq.reshape(num_heads, head_dim)
+    b_qvk[:, 1] = bv.reshape(num_heads, head_dim)
+    b_qvk[:, 2] = bk.reshape(num_heads, head_dim)
+    b_qvk = b_qvk.reshape(3 * bq.shape[0])
+    ln_scale = load_array(load_prefix + "self_attn_layer_norm.weight")
+    ln_bias = load_array(load_prefix + "self_attn_layer_norm.bias")
+    if config.fold_layer_norm:
+        w_qvk, b_qvk = fold_layer_norm_np(ln_scale, ln_bias, w_qvk, b_qvk)
+    else:
+        load_param("attention.layer_norm.scale", ln_scale)
+        load_param("attention.layer_norm.bias", ln_bias)
+    load_kernel("attention.self.qvk_combined", w_qvk)
+    load_param("attention.self.qvk_combined.bias", b_qvk)
+    load_kernel(
+        "attention.dense",
+        np.transpose(load_array(load_prefix + "self_attn.out_proj.weight")))
+    load_param("attention.dense.bias",
+               load_array(load_prefix + "self_attn.out_proj.bias"))
+    # FFN weights
+    w_fc1 = np.transpose(load_array(load_prefix + "fc1.weight"))
+    b_fc1 = load_array(load_prefix + "fc1.bias")
+    ln_scale = load_array(load_prefix + "final_layer_norm.weight")
+    ln_bias = load_array(load_prefix + "final_layer_norm.bias")
+    if config.fold_layer_norm:
+        w_fc1, b_fc1 = fold_layer_norm_np(ln_scale, ln_bias, w_fc1, b_fc1)
+    else:
+        load_param("ffn.layer_norm.scale", ln_scale)
+        load_param("ffn.layer_norm.bias", ln_bias)
+    load_param("ffn.fc1.bias", b_fc1)
+    load_kernel("ffn.fc1", w_fc1)
+    load_param("ffn.fc2.bias", load_array(load_prefix + "fc2.bias"))
+    load_kernel("ffn.fc2", np.transpose(load_array(load_prefix + "fc2.weight")))
+
+    return layer_params
+
+
+def load_layers_np(load_param,
+                   load_array,
+                   layer_ids,
+                   config,
+                   num_prefetch_layers=4):
+    """Load the params of the transformer layers in layer_ids with load_param.
+
+    The next num_prefetch_layers layers are read and packed by a thread pool
+    while the current one is passed to load_param. If config.scan_layers is
+    set, the params of the layers in a pipeline stage are stacked along a new
+    leading axis, which is the layout of nn.scan.
+    """
+    layers_per_stage = config.decoder_layers // (config.num_pp_stages or 1)
+    stacked_params = {}
+    layer_ids = iter(layer_ids)
+    with ThreadPoolExecutor(max_workers=num_prefetch_layers) as executor:
+
+        def submit(i):
+            return i, executor.submit(get_layer_params_np, load_array, i,
+                                      config)
+
+        # Keep a bounded window of layers in flight, so that the host memory
+        # stays bounded as well.
+        futures = deque(
+            submit(i) for i in itertools.islice(layer_ids, num_prefetch_layers))
+        while futures:
+            i, future = futures.popleft()
+            for next_i in itertools.islice(layer_ids, 1):
+                futures.append(submit(next_i))
+            layer_params = future.result()
+            for key, array in layer_params:
+                if config.scan_layers:
+                    stacked_params.setdefault((i // layers_per_stage, key),
+                                              []).append(array)
+                else:
+                    load_param(f"params.transformers.encoder.{i}.{key}",
+                               array)
+
+    for (stage_id, key), arrays in stacked_params.items():
+        load_param(f"params.transformers.encoder.{stage_id}.{key}",
+                   np.stack(arrays))
+
+
 def load_params_np(params, path, config, dummy=False):
     if dummy:
         np_dtype = np.float32 if config.dtype == jnp.float32 else np.float16
-        return jax.tree_map(lambda x: np.full(x.shape, 1e-9, np_dtype), params)
+        return jax.tree_map(
+            lambda x: np.full(x.shape, 1e-9,
+                              x.dtype if x.dtype == jnp.int8 else np_dtype),
+            params)
 
     def load_array(key):
-        return np.load(os.path.join(path, key))
+        # Memory-map the file, so only the bytes that are used are read.
+        return np.load(os.path.join(path, key), mmap_mode="r")
 
     def load_param(param_key, loaded_array):
         param_dict = params
@@ -610,65 +1120,46 @@ def load_params_np(params, path, config, dummy=False):
                    load_array("decoder.layer_norm.weight"))
         load_param("params.transformers.layer_norm.bias",
                    load_array("decoder.layer_norm.bias"))
-    for i in tqdm(range(config.decoder_layers)):
-        param_prefix = f"params.transformers.encoder.{i}."
-        load_prefix = f"decoder.layers.{i}."
-        # Attention weights
-        wq = load_array(load_prefix + "self_attn.q_proj.weight")
-        wk = load_array(load_prefix + "self_attn.k_proj.weight")
-        wv = load_array(load_prefix + "self_attn.v_proj.weight")
-        dim = wq.shape[-1]
-        w_qvk = np.concatenate([wq, wv, wk], axis=0).reshape(
-            (3, -1, dim)).transpose([2, 1, 0]).reshape((dim, -1))
-        load_param(param_prefix + "attention.self.qvk_combined.kernel", w_qvk)
-        bq = load_array(load_prefix + "self_attn.q_proj.bias")
-        bk = load_array(load_prefix + "self_attn.k_proj.bias")
-        bv = load_array(load_prefix + "self_attn.v_proj.bias")
-        b_qvk = np.concatenate([bq, bv, bk], axis=0).reshape(
-            (3, dim)).transpose([1, 0]).reshape((-1,))
-        load_param(param_prefix + "attention.self.qvk_combined.bias", b_qvk)
-        load_param(
-            param_prefix + "attention.dense.kernel",
-            np.transpose(load_array(load_prefix + "self_attn.out_proj.weight")))
-        load_param(param_prefix + "attention.dense.bias",
-                   load_array(load_prefix + "self_attn.out_proj.bias"))
-        load_param(param_prefix + "attention.layer_norm.scale",
-                   load_array(load_prefix + "self_attn_layer_norm.weight"))
-        load_param(param_prefix + "attention.layer_norm.bias",
-                   load_array(load_prefix + "self_attn_layer_norm.bias"))
-        # FFN weights
-        load_param(param_prefix + "ffn.fc1.bias",
-                   load_array(load_prefix + "fc1.bias"))
-        load_param(param_prefix + "ffn.fc1.kernel",
-                   np.transpose(load_array(load_prefix + "fc1.weight")))
-        load_param(param_prefix + "ffn.fc2.bias",
-                   load_array(load_prefix + "fc2.bias"))
-        load_param(param_prefix + "ffn.fc2.kernel",
-                   np.transpose(load_array(load_prefix + "fc2.weight")))
-        load_param(param_prefix + "ffn.layer_norm.scale",
-                   load_array(load_prefix + "final_layer_norm.weight"))
-        load_param(param_prefix + "ffn.layer_norm.bias",
-                   load_array(load_prefix + "final_layer_norm.bias"))
+    load_layers_np(load_param, load_array,
+                   tqdm(range(config.decoder_layers)), config)
 
     return flax.core.freeze(params)
 
 
 def get_jax_executable(config,
+                       batch_size=1,
                        support_output_attentions=False,
-                       support_output_hidden_states=False):
+                       support_output_hidden_states=False,
+                       num_tokens=1):
+    """Compile a step that runs num_tokens tokens with the attention cache.
+
+    num_tokens=1 compiles a decoding step. Use the prompt length to compile a
+    separate prefill step that writes the whole prompt into the cache, so
+    that each of the two gets its own shape-specialized executable.
+    """
     model, params = init_model_aval(config)
 
-    @jax.jit
+    # Donate the batch, so that XLA updates the cache in place instead of
+    # copying the full cache of every layer on each step.
+    @partial(jax.jit, donate_argnums=(1,))
     def inference_step(params, batch):
         output = model.apply(params,
                              batch["input_ids"],
-                             batch["position_ids"],
                              attention_cache=batch["cache"],
                              output_attentions=support_output_attentions,
                              output_hidden_states=support_output_hidden_states)
         return output
 
-    executable = inference_step
+    # Compile ahead of time for the shapes of one step. Calling the compiled
+    # executable directly skips the tracing cache lookup of jax.jit on every
+    # step.
+    executable = inference_step.lower(
+        params, {
+            "input_ids":
+                jax.ShapeDtypeStruct((batch_size, num_tokens), jnp.int32),
+            "cache":
+                jax.eval_shape(partial(init_cache_jnp, config, batch_size)),
+        }).compile()
     return executable, params
 
 
@@ -681,7 +1172,6 @@ def get_pipeshard_executable(config,
                              autoregressive=True):
     if autoregressive:
         assert num_micro_batches == 1, "we only support num_micro_batches=1 for autoregressive!"
-        assert batch_size == 1, "we only support batch_sie = 1 for autoregressive!"
 
     # Init model
     model, params = init_model_aval(config)
@@ -692,24 +1182,27 @@ def get_pipeshard_executable(config,
 
     if autoregressive:
 
-        @alpa.parallelize(batch_argnums=(1,), method=method)
+        # Donate the batch, so that the cache is updated in place instead of
+        # copying the full cache of every layer on each step.
+        @alpa.parallelize(batch_argnums=(1,),
+                          donate_argnums=(1,),
+                          method=method)
         @alpa.manual_layer_construction
         def inference_step_with_cache(params, batch):
             output = model.apply(
                 params,
                 batch["input_ids"],
-                batch["position_ids"],
                 attention_cache=batch["cache"],
                 output_attentions=support_output_attentions,
                 output_hidden_states=support_output_hidden_states)
             return output
 
-        alpa.global_config.always_donate_micro_batch_vars = False
+        # Decode one token for each of the batch_size sequences per step, so
+        # that the weights are read once for the whole batch.
         executable = inference_step_with_cache.get_executable(
             params, {
-                "input_ids": jax.core.ShapedArray((1, 1), jnp.int32),
-                "position_ids": jax.core.ShapedArray((1, 1), jnp.int32),
-                "cache": init_cache_aval(config, 1),
+                "input_ids": jax.core.ShapedArray((batch_size, 1), jnp.int32),
+                "cache": init_cache_aval(config, batch_size),
             })
     else:
 
@@ -742,10 +1235,19 @@ def get_pipeshard_executable(config,
 
 
 def load_opt_params_worker_func(self, path, prefix_to_idx, config, shapes,
-                                uuids, indices, mesh_ids):
+                                uuids, indices, mesh_ids,
+                                num_pending_copies_per_device=16):
 
     def load_array(key):
-        return np.load(os.path.join(path, key))
+        # Memory-map the file, so only the bytes that are used are read.
+        return np.load(os.path.join(path, key), mmap_mode="r")
+
+    # Copy the params to the devices in background threads, so that the
+    # copies overlap with reading and packing the next layers. Wait for the
+    # oldest copy when too many are pending, which bounds the host memory
+    # held by the pending copies.
+    pending_copies = deque()
+    max_pending_copies = num_pending_copies_per_device * len(self.local_devices)
 
     def load_param(param_key, loaded_array):
         i = prefix_to_idx[param_key]
@@ -759,64 +1261,33 @@ def load_opt_params_worker_func(self, path, prefix_to_idx, config, shapes,
                 idx = self.host_id * len(self.local_devices) + k
                 uuid = uuids[i][j][idx]
                 data = loaded_array[indices[i][j][idx]]
-                self.put_buffer(uuid, k, data)
-
-    load_param("params.transformers.embeddings.word_embeddings.embedding",
-               load_array("decoder.embed_tokens.weight"))
-    load_param("params.transformers.embeddings.position_embeddings.embedding",
-               load_array("decoder.embed_positions.weight"))
-
-    if config.version > 2:
-        load_param("params.transformers.layer_norm.scale",
-                   load_array("decoder.layer_norm.weight"))
-        load_param("params.transformers.layer_norm.bias",
-                   load_array("decoder.layer_norm.bias"))
-
-    layers_per_stage = config.decoder_layers // config.num_pp_stages
-
-    for i in range(config.decoder_layers):
-        stage_id = i // layers_per_stage
-        if stage_id != self.mesh_id:
-            continue
-
-        param_prefix = f"params.transformers.encoder.{i}."
-        load_prefix = f"decoder.layers.{i}."
-        # Attention weights
-        wq = load_array(load_prefix + "self_attn.q_proj.weight")
-        wk = load_array(load_prefix + "self_attn.k_proj.weight")
-        wv = load_array(load_prefix + "self_attn.v_proj.weight")
-        dim = wq.shape[-1]
-        w_qvk = np.concatenate([wq, wv, wk], axis=0).reshape(
-            (3, -1, dim)).transpose([2, 1, 0]).reshape((dim, -1))
-        load_param(param_prefix + "attention.self.qvk_combined.kernel", w_qvk)
-        bq = load_array(load_prefix + "self_attn.q_proj.bias")
-        bk = load_array(load_prefix + "self_attn.k_proj.bias")
-        bv = load_array(load_prefix + "self_attn.v_proj.bias")
-        b_qvk = np.concatenate([bq, bv, bk], axis=0).reshape(
-            (3, dim)).transpose([1, 0]).reshape((-1,))
-        load_param(param_prefix + "attention.self.qvk_combined.bias", b_qvk)
+                pending_copies.append(
+                    executor.submit(self.put_buffer, uuid, k, data))
+                while len(pending_copies) > max_pending_copies:
+                    pending_copies.popleft().result()
+
+    with ThreadPoolExecutor(max_workers=len(self.local_devices)) as executor:
+        load_param("params.transformers.embeddings.word_embeddings.embedding",
+                   load_array("decoder.embed_tokens.weight"))
         load_param(
-            param_prefix + "attention.dense.kernel",
-            np.transpose(load_array(load_prefix + "self_attn.out_proj.weight")))
-        load_param(param_prefix + "attention.dense.bias",
-                   load_array(load_prefix + "self_attn.out_proj.bias"))
-        load_param(param_prefix + "attention.layer_norm.scale",
-                   load_array(load_prefix + "self_attn_layer_norm.weight"))
-        load_param(param_prefix + "attention.layer_norm.bias",
-                   load_array(load_prefix + "self_attn_layer_norm.bias"))
-        # FFN weights
-        load_param(param_prefix + "ffn.fc1.bias",
-                   load_array(load_prefix + "fc1.bias"))
-        load_param(param_prefix + "ffn.fc1.kernel",
-                   np.transpose(load_array(load_prefix + "fc1.weight")))
-        load_param(param_prefix + "ffn.fc2.bias",
-                   load_array(load_prefix + "fc2.bias"))
-        load_param(param_prefix + "ffn.fc2.kernel",
-                   np.transpose(load_array(load_prefix + "fc2.weight")))
-        load_param(param_prefix + "ffn.layer_norm.scale",
-                   load_array(load_prefix + "final_layer_norm.weight"))
-        load_param(param_prefix + "ffn.layer_norm.bias",
-                   load_array(load_prefix + "final_layer_norm.bias"))
+            "params.transformers.embeddings.position_embeddings.embedding",
+            load_array("decoder.embed_positions.weight"))
+
+        if config.version > 2:
+            load_param("params.transformers.layer_norm.scale",
+                       load_array("decoder.layer_norm.weight"))
+            load_param("params.transformers.layer_norm.bias",
+                       load_array("decoder.layer_norm.bias"))
+
+        layers_per_stage = config.decoder_layers // config.num_pp_stages
+        layer_ids = [
+            i for i in range(config.decoder_layers)
+            if i // layers_per_stage == self.mesh_id
+        ]
+        load_layers_np(load_param, load_array, layer_ids, config)
+
+        while pending_copies:
+            pending_copies.popleft().result()
 
 
 setattr(MeshHostWorker, "load_opt_params_worker_func",
@@ -11,7 +11,7 @@ from transformers import OPTForCausalLM, GPT2LMHeadModel
 
 from examples.opt_serving.model.opt_model import (
     get_opt_config, get_pipeshard_executable, load_params_dis_array,
-    init_cache_dis_array, load_params_np, init_cache_np, get_jax_executable)
+    init_cache_dis_array, load_params_np, init_cache_jnp, get_jax_executable)
 from examples.opt_serving.model.opt_utils import TransformerModelConfig
 
 
@@ -63,15 +63,22 @@ class WrappedInferenceFunc(GenerationMixin):
     Wrap an inference func as a GenerationMixin.
     This class implements the minimal interface for using huggingface's generator.
 
-    This class also decomposes the first call of prompt during generation to one token by one token.
+    This class also decomposes the first call of prompt during generation to one token by one token,
+    unless prefill is set, in which case the whole prompt is passed to inference_func in one call.
     """
 
-    def __init__(self, inference_func, config, executable, transformer_config):
+    def __init__(self,
+                 inference_func,
+                 config,
+                 executable,
+                 transformer_config,
+                 prefill=False):
         self.inference_func = inference_func
         self.config = config
         self.main_input_name = "input_ids"
         self.executable = executable
         self.transformer_config = transformer_config
+        self.prefill = prefill
 
     def forward(self, attention_mask):
         raise NotImplementedError()
@@ -92,6 +99,12 @@ class WrappedInferenceFunc(GenerationMixin):
                  output_attentions=None,
                  output_hidden_states=None,
                  return_dict=None):
+        if self.prefill:
+            return self.inference_func(
+                input_ids,
+                past_key_values,
+                output_hidden_states=output_hidden_states,
+                output_attentions=output_attentions)
         for i in range(input_ids.shape[1]):
             ret = self.inference_func(input_ids[:, i:i + 1],
                                       past_key_values,
@@ -169,17 +182,26 @@ def get_model(model_name,
               path,
               autoregressive=True,
               dtype=jnp.float16,
+              kv_cache_dtype=None,
               dummy=False,
               batch_size=1,
               decoding_length_per_step=1,
               num_micro_batches=1,
               support_output_attentions=False,
-              support_output_hidden_states=False):
+              support_output_hidden_states=False,
+              prefill=False):
     """Get and load model and return a WrappedInferenceFunc compatible with HuggingFace.
 
     Args:
         model_name: "gpt", "facebook/opt-", or "alpa/opt-".
+        kv_cache_dtype: The dtype of the attention cache. None means using
+          dtype. jnp.int8 stores a quantized cache.
+        prefill: Run each prompt in one step instead of one token at a time.
+          Only "jax/opt-" supports it. It compiles one executable for each
+          new prompt length, so use it only with a few distinct lengths.
     """
+    if prefill and "jax/opt" not in model_name:
+        raise NotImplementedError(f"Cannot support prefill for {model_name}.")
     if not model_name.startswith("alpa") and not autoregressive:
         raise NotImplementedError(
             f"Cannot support {model_name} in forward-only mode.")
@@ -205,7 +227,8 @@ def get_model(model_name,
         config = get_opt_config(name,
                                 num_pp_stages=None,
                                 mark_boundary=False,
-                                dtype=dtype)
+                                dtype=dtype,
+                                kv_cache_dtype=kv_cache_dtype)
         transformer_config = TransformerModelConfig(
             H=config.decoder_embed_dim,
             L=config.decoder_layers,
@@ -215,18 +238,40 @@ def get_model(model_name,
 
         executable, params_aval = get_jax_executable(
             config,
+            batch_size=batch_size,
             support_output_attentions=support_output_attentions,
             support_output_hidden_states=support_output_hidden_states)
 
+        # With prefill, compile an executable for each prompt length on first
+        # use, which runs the whole prompt in one step instead of one token
+        # at a time. The decoding executable is the one for one token.
+        executables = {1: executable}
+
+        def get_executable(num_tokens):
+            if num_tokens not in executables:
+                executables[num_tokens], _ = get_jax_executable(
+                    config,
+                    batch_size=batch_size,
+                    support_output_attentions=support_output_attentions,
+                    support_output_hidden_states=support_output_hidden_states,
+                    num_tokens=num_tokens)
+            return executables[num_tokens]
+
         # Load params
         params = load_params_np(params_aval, path, config, dummy)
-        params = jax.tree_map(jnp.array, params)
-        init_cache = init_cache_np(config, 1)
+        params = jax.tree_map(jax.device_put, params)
+        # The executable donates the cache, so each generation starts with a
+        # new one. It is allocated on device without a host copy.
+        def get_init_cache():
+            return init_cache_jnp(config, batch_size)
     else:
         assert "alpa/opt" in model_name
         alpa.init()
         num_pp_stages = max(2, alpa.get_global_cluster().num_hosts)
-        config = get_opt_config(name, num_pp_stages=num_pp_stages, dtype=dtype)
+        config = get_opt_config(name,
+                                num_pp_stages=num_pp_stages,
+                                dtype=dtype,
+                                kv_cache_dtype=kv_cache_dtype)
         transformer_config = TransformerModelConfig(
             H=config.decoder_embed_dim,
             L=config.decoder_layers,
@@ -246,53 +291,59 @@ def get_model(model_name,
         # Load params
         params = load_params_dis_array(path, executable, params_aval, config,
                                        dummy)
-        if autoregressive:
-            init_cache = init_cache_dis_array(executable,
-                                              config,
-                                              1,
-                                              dummy=dummy)
-            set_skip_shard_args_check(init_cache)
         executable.sync()
 
         # return executable directly if not autoregressive
         if not autoregressive:
             return executable, params, transformer_config
 
-    step_ct = 0
+        # The executable donates the cache, so each generation starts with a
+        # new one.
+        def get_init_cache():
+            init_cache = init_cache_dis_array(executable,
+                                              config,
+                                              batch_size,
+                                              dummy=dummy)
+            set_skip_shard_args_check(init_cache)
+            return init_cache
+
+        # Prompts are fed one token at a time, as prefill is not set.
+        def get_executable(_num_tokens):
+            return executable
 
     def inference_func(input_ids,
                        past_key_values,
                        output_attentions=False,
                        output_hidden_states=False):
-        nonlocal step_ct
-
         if past_key_values is None:
-            past_key_values = init_cache
-            step_ct = 0
+            past_key_values = get_init_cache()
 
-        input_ids_step = input_ids.cpu().numpy()
-        position_ids_step = np.full_like(input_ids_step,
-                                         step_ct + config.pad + 1)
+        input_ids_step = input_ids.cpu().numpy().astype(np.int32)
 
         # tic = time.time()
-        output = executable(
-            params, {
-                "input_ids": input_ids_step,
-                "position_ids": position_ids_step,
-                "cache": past_key_values,
-            })
+        # The executable derives the position ids from the cache index.
+        output = get_executable(input_ids_step.shape[1])(params, {
+            "input_ids": input_ids_step,
+            "cache": past_key_values,
+        })
         set_skip_shard_args_check(output.attention_cache)
         # executable.sync()
 
-        logits_step = torch.from_numpy(np.array(output.logits)).to(device)
+        logits_step = output.logits
+        if prefill:
+            # The generator only reads the logits of the last token.
+            logits_step = logits_step[:, -1:]
+        logits_step = torch.from_numpy(np.array(logits_step)).to(device)
 
-        step_ct += 1
         return InferenceFuncOutput(logits_step, output.attention_cache,
                                    output.hidden_states, output.attentions)
 
     inference_func_config = InferenceFuncConfig()
-    return WrappedInferenceFunc(inference_func, inference_func_config,
-                                executable, transformer_config)
+    return WrappedInferenceFunc(inference_func,
+                                inference_func_config,
+                                executable,
+                                transformer_config,
+                                prefill=prefill)
 
 
 def set_skip_shard_args_check(attention_cache):